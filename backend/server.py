@@ -1,38 +1,134 @@
 from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Form
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.responses import ORJSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import DuplicateKeyError
 import os
+import re
+import base64
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict, EmailStr
 from typing import List, Optional
 import uuid
+import asyncio
+import hashlib
+import hmac
+import secrets
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone, timedelta
 import bcrypt
 import jwt
 from emergentintegrations.llm.chat import LlmChat, UserMessage, FileContentWithMimeType
 import tempfile
 import shutil
+import aiofiles
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, tz_aware=True)
 db = client[os.environ['DB_NAME']]
 
 # JWT configuration
 JWT_SECRET_KEY = os.environ.get('JWT_SECRET_KEY', 'your-secret-key-here')
 JWT_ALGORITHM = os.environ.get('JWT_ALGORITHM', 'HS256')
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 7 days
+# Decoding with a PyJWK reuses its prepared key instead of re-running prepare_key on every request
+JWT_VERIFY_KEY = jwt.PyJWK(
+    {"kty": "oct", "k": base64.urlsafe_b64encode(JWT_SECRET_KEY.encode('utf-8')).rstrip(b"=").decode('ascii')},
+    algorithm=JWT_ALGORITHM,
+)
+
+# Password hashing
+# Each +1 doubles hashing time; 10 keeps logins around tens of ms while staying brute-force resistant.
+BCRYPT_COST = int(os.environ.get('BCRYPT_COST', '10'))
+BCRYPT_SALT_PREFIX = b"$2b$%02d$" % BCRYPT_COST
+
+# Authenticated user cache
+# Keyed by sha256(token) so raw bearer tokens are never retained.
+JWT_CACHE_TTL_SECONDS = 5
+JWT_CACHE_MAX_ENTRIES = 10000
+_jwt_cache: dict[bytes, tuple[dict, float]] = {}
+_jwt_cache_order: deque = deque()
+_jwt_cache_lock = asyncio.Lock()
+
+# Password verification cache
+# Keys are HMACs with a per-process pepper so plaintext passwords are never held in memory.
+BCRYPT_CACHE_PEPPER = secrets.token_bytes(32)
+BCRYPT_CACHE_TTL_SECONDS = 30
+BCRYPT_CACHE_MAX_ENTRIES = 4096
+_bcrypt_cache: "OrderedDict[bytes, tuple[bool, float]]" = OrderedDict()
+_bcrypt_cache_lock = asyncio.Lock()
+
+# Upload streaming
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB
+# FileContentWithMimeType only accepts a path; set UPLOAD_TMP_ROOT (e.g. a sized tmpfs) to choose where uploads are staged
+UPLOAD_TMP_ROOT = os.environ.get('UPLOAD_TMP_ROOT') or None
+
+# LLM response parsing: section headers must start a line, as in the prompt's required format
+ANALYSIS_SECTION_RE = re.compile(r"^[ \t]*(DECISION|REASONING|CONFIDENCE):[ \t]*", re.M)
+
+# Claim history
+CLAIM_HISTORY_LIMIT = 100
 
 # Emergent LLM Key
 EMERGENT_LLM_KEY = os.environ.get('EMERGENT_LLM_KEY', '')
 
-app = FastAPI()
+# Claim analysis LLM configuration
+ANALYSIS_MODEL = ("gemini", "gemini-2.0-flash")
+ANALYSIS_SYSTEM_MESSAGE = "You are an expert insurance claim analyst. Analyze insurance claims based on policy rules."
+PDF_MIME_TYPE = "application/pdf"
+PDF_MAGIC = b"%PDF-"
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', str(25_000_000)))
+ANALYSIS_PROMPT = """Analyze this insurance claim submission carefully:
+
+1. First, extract all relevant rules and coverage criteria from the POLICY document
+2. Review the CLAIM form for what is being claimed
+3. Verify the BILLS for amounts and medical procedures
+4. Cross-check DOCTOR NOTES for medical necessity and diagnosis
+5. Determine if the claim should PASS or FAIL based on policy rules
+
+Provide your response in this exact format:
+
+DECISION: [PASS or FAIL]
+
+REASONING:
+[Detailed explanation of why the claim passes or fails, referencing specific policy rules and evidence from the documents]
+
+CONFIDENCE: [percentage, e.g., 85%]"""
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Indexes back every lookup in the auth and claims routes
+    await db.users.create_index("email", unique=True)
+    await db.users.create_index("id", unique=True)
+    await db.claim_analyses.create_index("id", unique=True)
+    await db.claim_analyses.create_index([("user_id", 1), ("analyzed_at", -1)])
+    
+    # Time one hash so operators can tune BCRYPT_COST
+    started = time.perf_counter()
+    probe = secrets.token_hex(8)
+    probe_hash = await hash_password(probe)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if not probe_hash.encode('utf-8').startswith(BCRYPT_SALT_PREFIX) or not await verify_password(probe, probe_hash):
+        raise RuntimeError(f"bcrypt self-check failed for cost {BCRYPT_COST}")
+    logger.info(
+        "bcrypt %s cost=%d: %.1f ms per hash",
+        bcrypt.__version__,
+        BCRYPT_COST,
+        elapsed_ms,
+    )
+    yield
+    client.close()
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 api_router = APIRouter(prefix="/api")
 security = HTTPBearer()
 
@@ -61,7 +157,7 @@ class TokenResponse(BaseModel):
 
 class ClaimAnalysis(BaseModel):
     model_config = ConfigDict(extra="ignore")
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=lambda: uuid.uuid4().hex)
     user_id: str
     policy_file: str
     claim_file: str
@@ -73,11 +169,33 @@ class ClaimAnalysis(BaseModel):
     analyzed_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 # Helper functions
-def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+async def hash_password(password: str) -> str:
+    hashed = await asyncio.to_thread(bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt(rounds=BCRYPT_COST))
+    return hashed.decode('utf-8')
 
-def verify_password(password: str, password_hash: str) -> bool:
-    return bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
+async def verify_password(password: str, password_hash: str) -> bool:
+    password_bytes = password.encode('utf-8')
+    hash_bytes = password_hash.encode('utf-8')
+    key = hmac.new(BCRYPT_CACHE_PEPPER, password_bytes + hash_bytes, hashlib.sha256).digest()
+    
+    async with _bcrypt_cache_lock:
+        cached = _bcrypt_cache.get(key)
+        if cached is not None:
+            result, expiry = cached
+            if expiry > time.monotonic():
+                _bcrypt_cache.move_to_end(key)
+                return result
+            del _bcrypt_cache[key]
+    
+    # bcrypt is deliberately slow; keep it off the event loop
+    result = await asyncio.to_thread(bcrypt.checkpw, password_bytes, hash_bytes)
+    
+    async with _bcrypt_cache_lock:
+        _bcrypt_cache[key] = (result, time.monotonic() + BCRYPT_CACHE_TTL_SECONDS)
+        _bcrypt_cache.move_to_end(key)
+        while len(_bcrypt_cache) > BCRYPT_CACHE_MAX_ENTRIES:
+            _bcrypt_cache.popitem(last=False)
+    return result
 
 def create_access_token(data: dict) -> str:
     to_encode = data.copy()
@@ -86,21 +204,82 @@ def create_access_token(data: dict) -> str:
     return jwt.encode(to_encode, JWT_SECRET_KEY, algorithm=JWT_ALGORITHM)
 
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    token = credentials.credentials
+    cache_key = hashlib.sha256(token.encode('utf-8')).digest()
+    cached = _jwt_cache.get(cache_key)
+    if cached is not None and cached[1] > time.time():
+        return cached[0]
+    
     try:
-        token = credentials.credentials
-        payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
+        payload = jwt.decode(token, JWT_VERIFY_KEY, algorithms=[JWT_ALGORITHM])
         user_id: str = payload.get("sub")
         if user_id is None:
             raise HTTPException(status_code=401, detail="Invalid authentication credentials")
         
-        user = await db.users.find_one({"id": user_id}, {"_id": 0})
+        # Users are keyed by their id in _id; older documents only carry the id field
+        projection = {"_id": 0, "password_hash": 0}
+        user = await db.users.find_one({"_id": user_id}, projection)
+        if user is None:
+            user = await db.users.find_one({"id": user_id}, projection)
         if user is None:
             raise HTTPException(status_code=401, detail="User not found")
-        return user
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token has expired")
-    except jwt.JWTError:
+    except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Could not validate credentials")
+    
+    now = time.time()
+    ttl = min(payload.get("exp", now + JWT_CACHE_TTL_SECONDS) - now, JWT_CACHE_TTL_SECONDS)
+    if ttl > 0:
+        if cache_key not in _jwt_cache:
+            _jwt_cache_order.append(cache_key)
+        _jwt_cache[cache_key] = (user, now + ttl)
+        if len(_jwt_cache_order) > JWT_CACHE_MAX_ENTRIES:
+            async with _jwt_cache_lock:
+                while len(_jwt_cache_order) > JWT_CACHE_MAX_ENTRIES:
+                    _jwt_cache.pop(_jwt_cache_order.popleft(), None)
+    return user
+
+async def save_upload(upload: UploadFile, path: str) -> None:
+    async with aiofiles.open(path, "wb") as f:
+        while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+            await f.write(chunk)
+
+async def validate_pdf_upload(upload: UploadFile) -> None:
+    if upload.content_type != PDF_MIME_TYPE:
+        raise HTTPException(status_code=415, detail=f"{upload.filename} must be a PDF")
+    if (upload.size or 0) > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"{upload.filename} exceeds {MAX_UPLOAD_BYTES} bytes")
+    header = await upload.read(len(PDF_MAGIC))
+    await upload.seek(0)
+    if header != PDF_MAGIC:
+        raise HTTPException(status_code=415, detail=f"{upload.filename} is not a valid PDF")
+
+def parse_analysis_response(response: str) -> tuple[str, str, Optional[float]]:
+    """Return (decision, reasoning, confidence) parsed from the LLM response."""
+    decision = "UNKNOWN"
+    reasoning = response
+    confidence = None
+    reasoning_found = False
+    
+    sections = list(ANALYSIS_SECTION_RE.finditer(response))
+    for i, match in enumerate(sections):
+        end = sections[i + 1].start() if i + 1 < len(sections) else len(response)
+        label = match.group(1)
+        if label == "REASONING":
+            if not reasoning_found:
+                reasoning = response[match.end():end].strip()
+                reasoning_found = True
+            continue
+        line = response[match.end():end].partition("\n")[0]
+        if label == "DECISION":
+            decision = "PASS" if "PASS" in line.upper() else "FAIL"
+        else:
+            try:
+                confidence = float(line.replace('%', '').strip())
+            except ValueError:
+                confidence = None
+    return decision, reasoning, confidence
 
 # Auth routes
 @api_router.post("/auth/register", response_model=TokenResponse)
@@ -113,13 +292,18 @@ async def register(user_data: UserRegister):
     # Create new user
     user = User(
         email=user_data.email,
-        password_hash=hash_password(user_data.password),
+        password_hash=await hash_password(user_data.password),
         full_name=user_data.full_name
     )
     
+    # Timestamps are stored as BSON dates, matching claim_analyses.analyzed_at
     user_dict = user.model_dump()
-    user_dict['created_at'] = user_dict['created_at'].isoformat()
-    await db.users.insert_one(user_dict)
+    user_dict['_id'] = user.id
+    try:
+        await db.users.insert_one(user_dict)
+    except DuplicateKeyError:
+        # Lost a concurrent registration race on the unique email index
+        raise HTTPException(status_code=400, detail="Email already registered")
     
     # Create token
     access_token = create_access_token(data={"sub": user.id})
@@ -136,7 +320,7 @@ async def register(user_data: UserRegister):
 @api_router.post("/auth/login", response_model=TokenResponse)
 async def login(credentials: UserLogin):
     user = await db.users.find_one({"email": credentials.email}, {"_id": 0})
-    if not user or not verify_password(credentials.password, user['password_hash']):
+    if not user or not await verify_password(credentials.password, user['password_hash']):
         raise HTTPException(status_code=401, detail="Invalid email or password")
     
     access_token = create_access_token(data={"sub": user['id']})
@@ -167,82 +351,44 @@ async def analyze_claim(
     doctor_notes: UploadFile = File(...),
     current_user = Depends(get_current_user)
 ):
+    temp_dir = None
     try:
-        # Save uploaded files temporarily
-        temp_dir = tempfile.mkdtemp()
+        # Reject non-PDF or oversized uploads before any disk or LLM work
+        for upload in (policy, claim, bills, doctor_notes):
+            await validate_pdf_upload(upload)
         
-        policy_path = os.path.join(temp_dir, f"policy_{uuid.uuid4()}.pdf")
-        claim_path = os.path.join(temp_dir, f"claim_{uuid.uuid4()}.pdf")
-        bills_path = os.path.join(temp_dir, f"bills_{uuid.uuid4()}.pdf")
-        doctor_path = os.path.join(temp_dir, f"doctor_{uuid.uuid4()}.pdf")
+        # Save uploaded files temporarily
+        temp_dir = await asyncio.to_thread(tempfile.mkdtemp, dir=UPLOAD_TMP_ROOT)
         
-        with open(policy_path, "wb") as f:
-            shutil.copyfileobj(policy.file, f)
-        with open(claim_path, "wb") as f:
-            shutil.copyfileobj(claim.file, f)
-        with open(bills_path, "wb") as f:
-            shutil.copyfileobj(bills.file, f)
-        with open(doctor_path, "wb") as f:
-            shutil.copyfileobj(doctor_notes.file, f)
+        rid = secrets.token_hex(8)
+        pairs = [
+            (policy, os.path.join(temp_dir, f"policy_{rid}.pdf")),
+            (claim, os.path.join(temp_dir, f"claim_{rid}.pdf")),
+            (bills, os.path.join(temp_dir, f"bills_{rid}.pdf")),
+            (doctor_notes, os.path.join(temp_dir, f"doctor_{rid}.pdf")),
+        ]
+        await asyncio.gather(*(save_upload(upload, path) for upload, path in pairs))
         
         # Initialize Gemini chat with file support
         chat = LlmChat(
             api_key=EMERGENT_LLM_KEY,
-            session_id=f"claim_analysis_{uuid.uuid4()}",
-            system_message="You are an expert insurance claim analyst. Analyze insurance claims based on policy rules."
-        ).with_model("gemini", "gemini-2.0-flash")
+            session_id=f"claim_analysis_{rid}",
+            system_message=ANALYSIS_SYSTEM_MESSAGE
+        ).with_model(*ANALYSIS_MODEL)
         
-        # Create file attachments
-        policy_file = FileContentWithMimeType(file_path=policy_path, mime_type="application/pdf")
-        claim_file = FileContentWithMimeType(file_path=claim_path, mime_type="application/pdf")
-        bills_file = FileContentWithMimeType(file_path=bills_path, mime_type="application/pdf")
-        doctor_file = FileContentWithMimeType(file_path=doctor_path, mime_type="application/pdf")
+        # Create file attachments (policy, claim, bills, doctor notes)
+        file_contents = [FileContentWithMimeType(file_path=path, mime_type=PDF_MIME_TYPE) for _, path in pairs]
         
         # Analyze with AI
-        prompt = """Analyze this insurance claim submission carefully:
-
-1. First, extract all relevant rules and coverage criteria from the POLICY document
-2. Review the CLAIM form for what is being claimed
-3. Verify the BILLS for amounts and medical procedures
-4. Cross-check DOCTOR NOTES for medical necessity and diagnosis
-5. Determine if the claim should PASS or FAIL based on policy rules
-
-Provide your response in this exact format:
-
-DECISION: [PASS or FAIL]
-
-REASONING:
-[Detailed explanation of why the claim passes or fails, referencing specific policy rules and evidence from the documents]
-
-CONFIDENCE: [percentage, e.g., 85%]"""
-        
         user_message = UserMessage(
-            text=prompt,
-            file_contents=[policy_file, claim_file, bills_file, doctor_file]
+            text=ANALYSIS_PROMPT,
+            file_contents=file_contents
         )
         
         response = await chat.send_message(user_message)
         
         # Parse AI response
-        decision = "UNKNOWN"
-        reasoning = response
-        confidence = None
-        
-        if "DECISION:" in response:
-            lines = response.split('\n')
-            for line in lines:
-                if line.strip().startswith("DECISION:"):
-                    decision_text = line.split("DECISION:")[1].strip()
-                    decision = "PASS" if "PASS" in decision_text.upper() else "FAIL"
-                elif line.strip().startswith("CONFIDENCE:"):
-                    conf_text = line.split("CONFIDENCE:")[1].strip()
-                    try:
-                        confidence = float(conf_text.replace('%', '').strip())
-                    except:
-                        confidence = None
-            
-            if "REASONING:" in response:
-                reasoning = response.split("REASONING:")[1].split("CONFIDENCE:")[0].strip()
+        decision, reasoning, confidence = parse_analysis_response(response)
         
         # Save analysis to database
         analysis = ClaimAnalysis(
@@ -256,35 +402,35 @@ CONFIDENCE: [percentage, e.g., 85%]"""
             confidence_score=confidence
         )
         
+        # Keep analyzed_at a BSON date so history sorts on the (user_id, analyzed_at) index natively
         analysis_dict = analysis.model_dump()
-        analysis_dict['analyzed_at'] = analysis_dict['analyzed_at'].isoformat()
         await db.claim_analyses.insert_one(analysis_dict)
         
-        # Cleanup temp files
-        shutil.rmtree(temp_dir)
-        
         return {
             "id": analysis.id,
             "decision": decision,
             "reasoning": reasoning,
             "confidence_score": confidence,
-            "analyzed_at": analysis.analyzed_at.isoformat()
+            "analyzed_at": analysis.analyzed_at
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error analyzing claim: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error analyzing claim: {str(e)}")
+    finally:
+        # Cleanup uploads and temp files even when analysis fails
+        await asyncio.gather(policy.close(), claim.close(), bills.close(), doctor_notes.close())
+        if temp_dir:
+            await asyncio.to_thread(shutil.rmtree, temp_dir, ignore_errors=True)
 
 @api_router.get("/claims/history")
 async def get_claim_history(current_user = Depends(get_current_user)):
     claims = await db.claim_analyses.find(
         {"user_id": current_user['id']},
         {"_id": 0}
-    ).sort("analyzed_at", -1).to_list(100)
-    
-    for claim in claims:
-        if isinstance(claim.get('analyzed_at'), str):
-            claim['analyzed_at'] = datetime.fromisoformat(claim['analyzed_at']).isoformat()
+    ).sort("analyzed_at", -1).to_list(CLAIM_HISTORY_LIMIT)
     
     return claims
 
@@ -314,8 +460,4 @@ logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
-logger = logging.getLogger(__name__)
-
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+logger = logging.getLogger(__name__)
\ No newline at end of file
@@ -248,6 +248,59 @@ startxref
             self.log_test("Claim Analysis", False, f"Exception: {str(e)}")
             return False
 
+    def test_invalid_claim_upload(self):
+        """Test that non-PDF uploads are rejected before analysis"""
+        _, before = self.run_test(
+            "Claim History Before Invalid Upload",
+            "GET",
+            "claims/history",
+            200
+        )
+        
+        try:
+            valid_pdf = self.create_test_pdf("Valid supporting document")
+            with open(valid_pdf, 'rb') as f:
+                pdf_bytes = f.read()
+            os.unlink(valid_pdf)
+            
+            # (name, policy upload, expected status)
+            cases = [
+                ("Invalid Claim Upload (missing %PDF- header)",
+                 ('policy.pdf', b'This is not a PDF document', 'application/pdf'), 415),
+                ("Invalid Claim Upload (wrong content type)",
+                 ('policy.txt', pdf_bytes, 'text/plain'), 415),
+                ("Invalid Claim Upload (over size limit)",
+                 ('policy.pdf', b'%PDF-' + b'0' * 25_000_000, 'application/pdf'), 413),
+            ]
+            
+            success = True
+            for name, policy_upload, expected_status in cases:
+                files = {
+                    'policy': policy_upload,
+                    'claim': ('claim.pdf', pdf_bytes, 'application/pdf'),
+                    'bills': ('bills.pdf', pdf_bytes, 'application/pdf'),
+                    'doctor_notes': ('doctor_notes.pdf', pdf_bytes, 'application/pdf')
+                }
+                case_success, _ = self.run_test(name, "POST", "claims/analyze", expected_status, files=files)
+                success = success and case_success
+        except Exception as e:
+            self.log_test("Invalid Claim Upload", False, f"Exception: {str(e)}")
+            return False
+        
+        _, after = self.run_test(
+            "Claim History After Invalid Upload",
+            "GET",
+            "claims/history",
+            200
+        )
+        
+        if isinstance(before, list) and isinstance(after, list) and len(after) == len(before):
+            self.log_test("Invalid Upload Not Recorded", True, f"History unchanged at {len(after)} claims")
+        else:
+            self.log_test("Invalid Upload Not Recorded", False, "Rejected upload created a history entry")
+            return False
+        return success
+
     def test_claim_history(self):
         """Test getting claim history"""
         success, response = self.run_test(
@@ -318,6 +371,7 @@ startxref
             ("User Login", self.test_user_login),
             ("Get Current User", self.test_get_current_user),
             ("Claim Analysis", self.test_claim_analysis),
+            ("Invalid Claim Upload", self.test_invalid_claim_upload),
             ("Claim History", self.test_claim_history),
             ("Invalid Login", self.test_invalid_login),
             ("Unauthorized Access", self.test_unauthorized_access),
@@ -0,0 +1,81 @@
+import os
+
+import pytest
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_database")
+
+pytest.importorskip("emergentintegrations")
+
+from backend.server import parse_analysis_response  # noqa: E402
+
+
+STANDARD_RESPONSE = """DECISION: PASS
+
+REASONING:
+The policy covers outpatient treatment up to $10,000.
+The bills total $500 and the doctor notes confirm medical necessity.
+
+CONFIDENCE: 85%"""
+
+MID_LINE_DECISION_RESPONSE = """The policy leaves the final DECISION: maybe to the adjuster.
+DECISION: PASS
+
+REASONING:
+Covered procedure.
+
+CONFIDENCE: 70%"""
+
+REASONING_FIRST_RESPONSE = """REASONING:
+The claimed procedure is excluded by section 4.2 of the policy.
+
+DECISION: FAIL
+
+CONFIDENCE: 92.5%"""
+
+UNSTRUCTURED_RESPONSE = "I could not read the attached documents."
+
+BAD_CONFIDENCE_RESPONSE = """DECISION: FAIL
+
+REASONING:
+Bills do not match the claim form.
+
+CONFIDENCE: high"""
+
+
+def test_standard_response():
+    decision, reasoning, confidence = parse_analysis_response(STANDARD_RESPONSE)
+    assert decision == "PASS"
+    assert reasoning == (
+        "The policy covers outpatient treatment up to $10,000.\n"
+        "The bills total $500 and the doctor notes confirm medical necessity."
+    )
+    assert confidence == 85.0
+
+
+def test_decision_must_start_a_line():
+    decision, reasoning, confidence = parse_analysis_response(MID_LINE_DECISION_RESPONSE)
+    assert decision == "PASS"
+    assert reasoning == "Covered procedure."
+    assert confidence == 70.0
+
+
+def test_reasoning_before_decision():
+    decision, reasoning, confidence = parse_analysis_response(REASONING_FIRST_RESPONSE)
+    assert decision == "FAIL"
+    assert reasoning == "The claimed procedure is excluded by section 4.2 of the policy."
+    assert confidence == 92.5
+
+
+def test_unstructured_response_falls_back_to_defaults():
+    decision, reasoning, confidence = parse_analysis_response(UNSTRUCTURED_RESPONSE)
+    assert decision == "UNKNOWN"
+    assert reasoning == UNSTRUCTURED_RESPONSE
+    assert confidence is None
+
+
+def test_unparseable_confidence():
+    decision, reasoning, confidence = parse_analysis_response(BAD_CONFIDENCE_RESPONSE)
+    assert decision == "FAIL"
+    assert reasoning == "Bills do not match the claim form."
+    assert confidence is None